@@ -1,6 +1,25 @@
 import sys
+import os
 import re
-
+import glob
+import time
+import json
+import hashlib
+import argparse
+import tempfile
+from array import array
+from itertools import islice
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
+
+
+# Bump whenever a change to the assembler alters its output, so that stale
+# cache entries are never served.
+ASSEMBLER_VERSION = '2'
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'hack-assembler')
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
 
 COMP_MAP = {
     '0'  : ('0', '101010'),
@@ -56,7 +75,7 @@ JUMP_MAP = {
 }
 
 
-SYMBOL_TABLE = {
+BUILTIN_SYMBOLS = MappingProxyType({
     'SP': '0',
     'LCL': '1',
     'ARG': '2',
@@ -80,7 +99,34 @@ SYMBOL_TABLE = {
     'R15': '15',
     'SCREEN': '16384',
     'KBD': '24576',
-}
+})
+
+
+def build_instruction_table():
+    # Every legal C-instruction, keyed by its source text. A comp without
+    # dest or jump is not encoded by assemble_single_line either.
+    table = {}
+    dests = [(None, '000'), *DEST_MAP.items()]
+    jumps = [(None, '000'), *JUMP_MAP.items()]
+
+    for comp, (a, c) in COMP_MAP.items():
+        for dest, dest_bits in dests:
+            for jump, jump_bits in jumps:
+                if dest is None and jump is None:
+                    continue
+
+                instr = comp
+                if dest is not None:
+                    instr = f'{dest}={instr}'
+                if jump is not None:
+                    instr = f'{instr};{jump}'
+
+                table[instr] = f'111{a}{c}{dest_bits}{jump_bits}'
+
+    return table
+
+
+INSTRUCTION_TABLE = build_instruction_table()
 
 
 def handle_ainstr(instr):
@@ -130,28 +176,43 @@ def assemble_single_line(asm_instruction):
     return None
 
 
-def build_symbol_table(asm_code):
+def strip_line(line):
+    line = ''.join(line.split())
+
+    # Ignore comments.
+    if line.startswith(r'//'):
+        return ''
+
+    # Delete comments on lines.
+    if r'//' in line:
+        line = line.split(r'//')[0]
+
+    return line
+
+
+def match_label(line):
+    if line[0] != '(':
+        return None
+
+    is_label_definition = re.match(r'^\((.+)\)', line)
+    if is_label_definition:
+        return is_label_definition.groups()[0]
+    return None
+
+
+def build_symbol_table(asm_code, symbol_table):
     new_asm_code = []
     for line in asm_code:
-        line = re.sub(r'[\n\t\s]*', '', line)
+        line = strip_line(line)
 
         # Ignore empty lines.
         if line == '':
             continue
 
-        # Ignore comments.
-        if line.startswith(r'//'):
-            continue
-
-        # Delete comments on lines.
-        if r'//' in line:
-            line = line.split(r'//')[0]
-
         # Handle label definition.
-        is_label_definition = re.match(r'^\((.+)\)', line)
-        if is_label_definition:
-            label = is_label_definition.groups()[0]
-            SYMBOL_TABLE[label] = str(len(new_asm_code))
+        label = match_label(line)
+        if label is not None:
+            symbol_table[label] = str(len(new_asm_code))
             continue
 
         new_asm_code.append(line)
@@ -159,43 +220,569 @@ def build_symbol_table(asm_code):
     return new_asm_code
 
 
-def handle_variables(asm_code):
-    RAM = 16
-    new_asm_code = []
-    
-    for line in asm_code:
-        is_a_instruction = re.match(r'^@([^/]+)', line)
-        if is_a_instruction and not re.match(r'^@[0-9]+', line):
-            variable = is_a_instruction.groups()[0]
-            if variable not in SYMBOL_TABLE:
-                SYMBOL_TABLE[variable] = str(RAM)
-                RAM += 1
-            line = line.replace(variable, SYMBOL_TABLE[variable])
-        new_asm_code.append(line)
+def scan_labels(asm_lines, symbol_table):
+    # Label-only first pass: records label addresses without keeping the
+    # instructions around.
+    address = 0
+    for line in asm_lines:
+        line = strip_line(line)
+        if line == '':
+            continue
 
-    return new_asm_code
+        label = match_label(line)
+        if label is not None:
+            symbol_table[label] = str(address)
+        else:
+            address += 1
+
+
+def iter_instructions(asm_lines):
+    for line in asm_lines:
+        line = strip_line(line)
+        if line != '' and match_label(line) is None:
+            yield line
+
+
+def parse_program(asm_lines):
+    # (instruction or label, line number, source) for every non-empty line,
+    # with labels kept in place as '(NAME)'.
+    program = []
+    for lineno, source in enumerate(asm_lines, 1):
+        line = strip_line(source)
+        if line != '':
+            program.append((line, lineno, source.strip()))
+    return program
+
+
+# C-instructions that undo each other when they follow one another.
+INVERSE_UPDATES = {
+    'M=M+1': 'M=M-1',
+    'M=M-1': 'M=M+1',
+    'D=D+1': 'D=D-1',
+    'D=D-1': 'D=D+1',
+    'A=A+1': 'A=A-1',
+    'A=A-1': 'A=A+1',
+}
 
 
-def assemble(asm_code):
-    asm_code = build_symbol_table(asm_code)
-    asm_code = handle_variables(asm_code)
+def numeric_jumps(program):
+    # Line numbers of the jumps whose target comes from an @<number>. The
+    # peephole rules move instructions, which would leave such targets
+    # pointing at the wrong place.
+    linenos = []
+    target = None
+    for line, lineno, _ in program:
+        if line[0] == '(':
+            continue
+        if line[0] == '@':
+            target = line[1:]
+            continue
+
+        # A jump goes to the value A held before the instruction.
+        if ';' in line and target is not None and target.isdigit():
+            linenos.append(lineno)
+
+        dest = line.split('=')[0] if '=' in line else ''
+        if 'A' in dest:
+            target = None
+
+    return linenos
+
+
+def peephole_pass(program):
+    # One pass of the peephole rules over a parsed program. Programs with
+    # numeric jump targets never get here, so every jump targets a label and
+    # removing instructions only moves label addresses. `known_a` is the
+    # A-instruction whose value A still holds.
+    new_program = []
+    known_a = None
+    index = 0
+
+    while index < len(program):
+        entry = program[index]
+        line = entry[0]
+        next_line = program[index + 1][0] if index + 1 < len(program) else ''
+        index += 1
+
+        # Labels are join points, so nothing is known about A after them.
+        if line[0] == '(':
+            known_a = None
+            new_program.append(entry)
+            continue
+
+        if line[0] == '@':
+            # A already holds this value.
+            if line == known_a:
+                continue
+
+            # A is overwritten before it is used.
+            if next_line.startswith('@'):
+                continue
+
+            # Jump to the instruction that follows anyway.
+            if ';' in next_line and '=' not in next_line:
+                following = index + 1
+                labels = set()
+                while following < len(program) and program[following][0][0] == '(':
+                    labels.add(match_label(program[following][0]))
+                    following += 1
+                if line[1:] in labels:
+                    index += 1
+                    continue
+
+            known_a = line
+            new_program.append(entry)
+            continue
+
+        # An update immediately undone by the next instruction.
+        if INVERSE_UPDATES.get(line) == next_line:
+            index += 1
+            continue
+
+        dest = line.split('=')[0] if '=' in line else ''
+        if 'A' in dest or ';' in line:
+            known_a = None
+        new_program.append(entry)
+
+    return new_program
+
+
+def optimize(program):
+    # Applies the peephole rules until none of them fires. Programs that
+    # jump to numeric addresses are returned unchanged.
+    if numeric_jumps(program):
+        return program
+
+    while True:
+        new_program = peephole_pass(program)
+        if len(new_program) == len(program):
+            return new_program
+        program = new_program
+
+
+def iter_encode(asm_code, symbol_table):
+    # Resolves variables and encodes in a single pass. Anything that is not a
+    # plain A-instruction or a table entry goes through assemble_single_line.
+    RAM = 16
 
-    machine_code = []
     for line in asm_code:
+        if line[0] == '@':
+            value = line[1:]
+            if value and not '0' <= value[0] <= '9':
+                if value not in symbol_table:
+                    symbol_table[value] = str(RAM)
+                    RAM += 1
+                value = symbol_table[value]
+                line = f'@{value}'
+
+            if value.isdigit():
+                yield handle_ainstr(value)
+                continue
+        else:
+            bin_code = INSTRUCTION_TABLE.get(line)
+            if bin_code is not None:
+                yield bin_code
+                continue
+
         bin_code = assemble_single_line(line)
         if bin_code is not None:
-            machine_code.append(bin_code)
+            yield bin_code
 
-    return machine_code
 
+def encode(asm_code, symbol_table):
+    return list(iter_encode(asm_code, symbol_table))
 
-if __name__ == '__main__':
-    filepath = sys.argv[1]
 
+class Assembler:
+    # Owns the symbol table of the program being assembled. The table is
+    # reseeded from BUILTIN_SYMBOLS on every run, so one instance can
+    # assemble any number of programs without leaking labels or variables.
+    # With optimize set, the peephole rules run before labels are resolved.
+    def __init__(self, cache=None, optimize=False):
+        self.symbol_table = dict(BUILTIN_SYMBOLS)
+        self.cache = cache
+        self.optimize = optimize
+
+    def reset(self):
+        self.symbol_table = dict(BUILTIN_SYMBOLS)
+
+    def assemble(self, asm_code):
+        self.reset()
+        if self.optimize:
+            program = parse_program(asm_code)
+            linenos = numeric_jumps(program)
+            if linenos:
+                print(f'warning: not optimizing, the jump on line {linenos[0]} '
+                      'targets a numeric address.', file=sys.stderr)
+            asm_code = [line for line, _, _ in optimize(program)]
+        asm_code = build_symbol_table(asm_code, self.symbol_table)
+        return encode(asm_code, self.symbol_table)
+
+    def assemble_file(self, filepath):
+        if self.cache is not None:
+            return from_image(self.assemble_file_image(filepath))
+
+        with open(filepath, 'r') as prog:
+            return self.assemble(prog.read().splitlines())
+
+    def assemble_image(self, asm_code):
+        return to_image(self.assemble(asm_code))
+
+    def assemble_file_image(self, filepath):
+        with open(filepath, 'r') as prog:
+            source = prog.read()
+
+        if self.cache is None:
+            return self.assemble_image(source.splitlines())
+
+        key = self.cache.key(source, self.optimize)
+        cached = self.cache.get(key)
+        if cached is not None:
+            image, self.symbol_table = cached
+            return image
+
+        image = self.assemble_image(source.splitlines())
+        self.cache.put(key, image, self.symbol_table)
+        return image
+
+    def iter_file(self, filepath):
+        # Streams the machine code of a file. The source is read twice, once
+        # for the labels and once for encoding, so memory use does not grow
+        # with the size of the program.
+        self.reset()
+        with open(filepath, 'r') as prog:
+            scan_labels(prog, self.symbol_table)
+
+        with open(filepath, 'r') as prog:
+            yield from iter_encode(iter_instructions(prog), self.symbol_table)
+
+    def assemble_many(self, filepaths):
+        for filepath in filepaths:
+            yield filepath, self.assemble_file(filepath)
+
+
+def assemble(asm_code):
+    return Assembler().assemble(asm_code)
+
+
+def to_image(machine_code):
+    # Program image with one unsigned 16-bit word per instruction.
+    return array('H', [int(line, 2) for line in machine_code])
+
+
+def image_to_bytes(image):
+    # Raw little-endian words, as stored in a binary .hack file.
+    if sys.byteorder == 'big':
+        image = array('H', image)
+        image.byteswap()
+    return image.tobytes()
+
+
+def image_from_bytes(data):
+    image = array('H')
+    image.frombytes(data)
+    if sys.byteorder == 'big':
+        image.byteswap()
+    return image
+
+
+def read_hack_file(filepath):
+    # Reads the program image of a text or packed binary .hack file.
+    with open(filepath, 'rb') as prog:
+        data = prog.read()
+
+    # Text files hold nothing but binary digits and whitespace.
+    if data.translate(None, b'01 \t\r\n'):
+        return image_from_bytes(data)
+    return array('H', [int(line, 2) for line in data.split()])
+
+
+def from_image(image):
+    return [f'{word:016b}' for word in image]
+
+
+class AssemblyCache:
+    # On-disk cache of assembled programs. An entry holds the symbol table as
+    # a JSON line followed by the packed program image, and is keyed by the
+    # SHA-256 of the assembler version and the source text. Reads refresh an
+    # entry's mtime, and the least recently used entries are evicted once
+    # the directory grows beyond max_size bytes.
+    def __init__(self, dirpath=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        self.dirpath = dirpath
+        self.max_size = max_size
+
+    def key(self, source, optimize=False):
+        digest = hashlib.sha256()
+        digest.update(ASSEMBLER_VERSION.encode())
+        digest.update(b'O\0' if optimize else b'\0')
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        entrypath = self._entrypath(key)
+        try:
+            with open(entrypath, 'rb') as entry:
+                symbol_table = json.loads(entry.readline())
+                image = image_from_bytes(entry.read())
+            os.utime(entrypath)
+        except (OSError, ValueError):
+            return None
+
+        return image, symbol_table
+
+    def put(self, key, image, symbol_table):
+        # The cache only saves time, so an entry that cannot be written is
+        # dropped instead of failing a build that has already succeeded.
+        tmppath = None
+        try:
+            os.makedirs(self.dirpath, exist_ok=True)
+
+            # Write to a temporary file first, so that concurrent readers
+            # never see a partial entry.
+            fd, tmppath = tempfile.mkstemp(dir=self.dirpath, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as entry:
+                entry.write(json.dumps(symbol_table).encode() + b'\n')
+                entry.write(image_to_bytes(image))
+            os.replace(tmppath, self._entrypath(key))
+            tmppath = None
+        except OSError:
+            if tmppath is not None:
+                try:
+                    os.remove(tmppath)
+                except OSError:
+                    pass
+            return
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        try:
+            scan = list(os.scandir(self.dirpath))
+        except OSError:
+            return
+
+        for entry in scan:
+            if not entry.name.endswith('.hackcache'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entrypath in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entrypath)
+            except OSError:
+                pass
+            total_size -= size
+
+    def _entrypath(self, key):
+        return os.path.join(self.dirpath, f'{key}.hackcache')
+
+
+def write_stream(machine_code, out, fmt='text', chunk_size=4096):
+    # Writes machine code from any iterable in fixed-size chunks. `out` must
+    # be a binary stream when fmt is 'bin'.
+    machine_code = iter(machine_code)
+    while True:
+        chunk = list(islice(machine_code, chunk_size))
+        if not chunk:
+            break
+
+        if fmt == 'bin':
+            out.write(image_to_bytes(to_image(chunk)))
+        else:
+            out.write(''.join(f'{line}\n' for line in chunk))
+
+
+def build_listing(asm_lines, optimized=False):
+    # One (address, line number, enclosing label, source) row per emitted
+    # instruction, where the enclosing label is the last label defined
+    # before the instruction.
+    program = parse_program(asm_lines)
+    if optimized:
+        program = optimize(program)
+
+    listing = []
+    address = 0
+    label = None
+    for line, lineno, source in program:
+        name = match_label(line)
+        if name is not None:
+            label = name
+            continue
+
+        listing.append((address, lineno, label, source))
+        address += 1
+
+    return listing
+
+
+def write_listing_files(filepath, symbol_table, optimized=False):
+    # Writes <name>.lst with the listing rows and <name>.map with the ROM
+    # address of every label and the RAM address of every variable, both as
+    # tab-separated text.
     with open(filepath, 'r') as prog:
-        content = prog.read().splitlines()
-        bin_code = assemble(content)
+        asm_lines = prog.read().splitlines()
+
+    # Label addresses are taken from the symbol table, since the optimizer
+    # may have moved them.
+    labels = dict.fromkeys(
+        name for name in (match_label(line) for line in map(strip_line, asm_lines) if line)
+        if name is not None
+    )
+    basepath = os.path.splitext(filepath)[0]
+
+    with open(basepath + '.lst', 'w') as out:
+        out.write('# address\tline\tlabel\tsource\n')
+        out.write(''.join(
+            f'{address}\t{lineno}\t{label or ""}\t{source}\n'
+            for address, lineno, label, source in build_listing(asm_lines, optimized)
+        ))
+
+    with open(basepath + '.map', 'w') as out:
+        for name in labels:
+            out.write(f'ROM\t{symbol_table[name]}\t{name}\n')
+        for name, address in symbol_table.items():
+            if name not in labels and name not in BUILTIN_SYMBOLS:
+                out.write(f'RAM\t{address}\t{name}\n')
+
+
+def read_symbol_map(filepath):
+    # Returns the labels and variables of a .map file, each as a dict from
+    # name to address.
+    labels = {}
+    variables = {}
+    with open(filepath, 'r') as symbol_map:
+        for line in symbol_map:
+            kind, address, name = line.rstrip('\n').split('\t', 2)
+            if kind == 'ROM':
+                labels[name] = int(address)
+            else:
+                variables[name] = int(address)
+
+    return labels, variables
+
+
+def find_asm_files(dirpath):
+    pattern = os.path.join(dirpath, '**', '*.asm')
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def timed_assemble_file(filepath, cache_dir=None, listing=False, optimize=False):
+    start = time.perf_counter()
+    cache = AssemblyCache(cache_dir) if cache_dir is not None else None
+    assembler = Assembler(cache, optimize)
+    machine_code = assembler.assemble_file(filepath)
+    elapsed = time.perf_counter() - start
+
+    if listing:
+        write_listing_files(filepath, assembler.symbol_table, optimize)
+
+    return machine_code, elapsed
+
+
+def write_hack_file(filepath, machine_code, fmt='text'):
+    if fmt == 'bin':
+        with open(filepath, 'wb') as out:
+            out.write(image_to_bytes(to_image(machine_code)))
+        return
+
+    with open(filepath, 'w') as out:
+        out.write(''.join(f'{line}\n' for line in machine_code))
+
+
+def assemble_tree(dirpath, jobs=1, fmt='text', cache_dir=None, listing=False,
+                  optimize=False):
+    # Files are assembled in parallel but written and reported in sorted
+    # order, so the output of a run does not depend on the scheduling.
+    filepaths = find_asm_files(dirpath)
+    start = time.perf_counter()
+    assemble_file = partial(timed_assemble_file, cache_dir=cache_dir,
+                            listing=listing, optimize=optimize)
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(assemble_file, filepaths))
+    else:
+        results = [assemble_file(filepath) for filepath in filepaths]
+
+    total_words = 0
+    for filepath, (machine_code, elapsed) in zip(filepaths, results):
+        write_hack_file(os.path.splitext(filepath)[0] + '.hack', machine_code, fmt)
+        total_words += len(machine_code)
+        print(f'{filepath}: {len(machine_code)} words in {elapsed * 1000:.1f} ms')
+
+    elapsed = time.perf_counter() - start
+    print(f'Assembled {len(filepaths)} files ({total_words} words) '
+          f'in {elapsed * 1000:.1f} ms using {jobs} job(s).')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Assemble Hack assembly into Hack machine code.')
+    parser.add_argument('path', help='an .asm file, or a directory to '
+                        'assemble every .asm file under')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes in directory mode')
+    parser.add_argument('-f', '--format', choices=['text', 'bin'],
+                        default='text', help="'text' writes one 16-character "
+                        "binary string per line, 'bin' writes packed "
+                        "little-endian 16-bit words")
+    parser.add_argument('--stream', action='store_true',
+                        help='assemble a single file in two streaming passes '
+                        'and write the output incrementally')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='apply peephole optimizations before encoding '
+                        '(skipped for programs that jump to numeric addresses)')
+    parser.add_argument('--listing', action='store_true',
+                        help='also write a .lst address-to-source listing and '
+                        'a .map symbol map next to each input file')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always assemble, bypassing the assembly cache')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='directory of the assembly cache '
+                        f'(default: {DEFAULT_CACHE_DIR})')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.stream and args.optimize:
+        raise ValueError('--optimize cannot be combined with --stream.')
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    if os.path.isdir(args.path):
+        assemble_tree(args.path, args.jobs, args.format, cache_dir,
+                      args.listing, args.optimize)
+        return
+
+    if args.stream:
+        assembler = Assembler()
+        out = sys.stdout.buffer if args.format == 'bin' else sys.stdout
+        write_stream(assembler.iter_file(args.path), out, args.format)
+        if args.listing:
+            write_listing_files(args.path, assembler.symbol_table)
+        return
+
+    cache = AssemblyCache(cache_dir) if cache_dir is not None else None
+    assembler = Assembler(cache, args.optimize)
+    bin_code = assembler.assemble_file(args.path)
+    if args.listing:
+        write_listing_files(args.path, assembler.symbol_table, args.optimize)
+
+    if args.format == 'bin':
+        sys.stdout.buffer.write(image_to_bytes(to_image(bin_code)))
+        return
 
     for line in bin_code:
         print(line)
 
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import argparse
+
+from assembler import (COMP_MAP, INSTRUCTION_TABLE, assemble, read_hack_file,
+                       read_symbol_map, to_image)
+
+
+# Text of every legal C-instruction, keyed by its 16-bit encoding. This is
+# the reverse of INSTRUCTION_TABLE, plus the comps without dest or jump.
+DECODE_TABLE = {int(bits, 2): instr for instr, bits in INSTRUCTION_TABLE.items()}
+DECODE_TABLE.update(
+    {int(f'111{a}{c}000000', 2): comp for comp, (a, c) in COMP_MAP.items()}
+)
+
+
+def invert(symbols):
+    # Maps each address to the first name defined for it.
+    names = {}
+    for name, address in symbols.items():
+        names.setdefault(address, name)
+    return names
+
+
+def symbolic_operand(value, next_instr, labels, variables):
+    # Picks the symbol an A-instruction most likely referred to: a label when
+    # A is used as a jump target or as a constant such as a return address,
+    # and a variable when A is used to address memory.
+    if next_instr is None:
+        return None
+
+    if ';' in next_instr:
+        return labels.get(value)
+
+    dest, _, comp = next_instr.rpartition('=')
+    if 'M' in dest or 'M' in comp:
+        return variables.get(value)
+
+    return labels.get(value)
+
+
+def disassemble(image, labels=None, variables=None):
+    # Returns the assembly text of a program image as a list of lines.
+    # `labels` and `variables` map names to addresses, as read from a .map
+    # file, and are used to restore symbols.
+    labels = invert(labels or {})
+    variables = invert(variables or {})
+
+    instrs = []
+    for word in image:
+        if word & 0x8000:
+            instr = DECODE_TABLE.get(word)
+            if instr is None:
+                raise ValueError(f'invalid instruction {word:016b}.')
+            instrs.append(instr)
+        else:
+            instrs.append(None)
+
+    asm_code = []
+    for address, word in enumerate(image):
+        if address in labels:
+            asm_code.append(f'({labels[address]})')
+
+        instr = instrs[address]
+        if instr is not None:
+            asm_code.append(instr)
+            continue
+
+        next_instr = instrs[address + 1] if address + 1 < len(instrs) else None
+        symbol = symbolic_operand(word, next_instr, labels, variables)
+        asm_code.append(f'@{symbol}' if symbol is not None else f'@{word}')
+
+    # A label can point just past the last instruction, e.g. the end label
+    # of a trailing comparison or the return label of a trailing call.
+    if len(image) in labels:
+        asm_code.append(f'({labels[len(image)]})')
+
+    return asm_code
+
+
+def check_round_trip(image, asm_code):
+    # Reassembles the disassembly and raises if it differs from the image.
+    reassembled = to_image(assemble(asm_code))
+    if reassembled == image:
+        return
+
+    for address, (word, new_word) in enumerate(zip(image, reassembled)):
+        if word != new_word:
+            raise ValueError(f'reassembly differs at address {address}: '
+                             f'{word:016b} became {new_word:016b}.')
+    raise ValueError(f'reassembly has {len(reassembled)} words '
+                     f'instead of {len(image)}.')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Disassemble Hack machine code into Hack assembly.')
+    parser.add_argument('program', help='a text or packed binary .hack file')
+    parser.add_argument('--map', help='symbol map to restore names from '
+                        '(default: the .map file next to the program, if any)')
+    parser.add_argument('--check', action='store_true',
+                        help='reassemble the output and fail unless it gives '
+                        'back the same program')
+    parser.add_argument('--time', action='store_true',
+                        help='report the decoding time on stderr')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    mappath = args.map
+    if mappath is None and os.path.isfile(os.path.splitext(args.program)[0] + '.map'):
+        mappath = os.path.splitext(args.program)[0] + '.map'
+    labels, variables = read_symbol_map(mappath) if mappath else ({}, {})
+
+    image = read_hack_file(args.program)
+    start = time.perf_counter()
+    asm_code = disassemble(image, labels, variables)
+    elapsed = time.perf_counter() - start
+
+    if args.check:
+        check_round_trip(image, asm_code)
+
+    print('\n'.join(asm_code))
+    if args.time:
+        print(f'Decoded {len(image)} words in {elapsed * 1000:.1f} ms.',
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
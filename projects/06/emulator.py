@@ -0,0 +1,420 @@
+import os
+import time
+import re
+import argparse
+from array import array
+from bisect import bisect_right
+
+from assembler import (Assembler, COMP_MAP, read_hack_file, read_symbol_map,
+                       scan_labels)
+
+
+RAM_SIZE = 32 * 1024
+
+# Python expressions for every comp mnemonic in terms of the A, D and M
+# values. Results are kept as unsigned 16-bit integers.
+COMP_EXPRESSIONS = {
+    '0'  : '0',
+    '1'  : '1',
+    '-1' : '0xFFFF',
+    'D'  : 'd',
+    'A'  : 'a',
+    'M'  : 'm',
+    '!D' : 'd ^ 0xFFFF',
+    '!A' : 'a ^ 0xFFFF',
+    '!M' : 'm ^ 0xFFFF',
+    '-D' : '-d & 0xFFFF',
+    '-A' : '-a & 0xFFFF',
+    '-M' : '-m & 0xFFFF',
+    'D+1': '(d + 1) & 0xFFFF',
+    'A+1': '(a + 1) & 0xFFFF',
+    'M+1': '(m + 1) & 0xFFFF',
+    'D-1': '(d - 1) & 0xFFFF',
+    'A-1': '(a - 1) & 0xFFFF',
+    'M-1': '(m - 1) & 0xFFFF',
+    'D+A': '(d + a) & 0xFFFF',
+    'D+M': '(d + m) & 0xFFFF',
+    'D-A': '(d - a) & 0xFFFF',
+    'D-M': '(d - m) & 0xFFFF',
+    'A-D': '(a - d) & 0xFFFF',
+    'M-D': '(m - d) & 0xFFFF',
+    'D&A': 'd & a',
+    'D&M': 'd & m',
+    'D|A': 'd | a',
+    'D|M': 'd | m',
+}
+
+# Conditions on the ALU output for each combination of jump bits.
+JUMP_CONDITIONS = {
+    0b001: '0 < out < 0x8000',
+    0b010: 'out == 0',
+    0b011: 'out < 0x8000',
+    0b100: 'out >= 0x8000',
+    0b101: 'out != 0',
+    0b110: 'out == 0 or out >= 0x8000',
+    0b111: 'True',
+}
+
+# The 7-bit a+c field of a C-instruction, mapped back to its mnemonic.
+COMP_CODES = {int(a + c, 2): comp for comp, (a, c) in COMP_MAP.items()}
+
+COMP_FUNCTIONS = {
+    comp: eval(f'lambda a, d, m: {expr}') for comp, expr in COMP_EXPRESSIONS.items()
+}
+
+
+def read_program(filepath):
+    # Returns the program image of an .asm file, a text .hack file or a
+    # packed binary .hack file.
+    if os.path.splitext(filepath)[1] == '.asm':
+        return Assembler().assemble_file_image(filepath)
+
+    return read_hack_file(filepath)
+
+
+def decode(word):
+    # Decodes one instruction into the tuple executed by Emulator.run:
+    # (is_a, value, comp, uses_m, dest_a, dest_d, dest_m, jump).
+    if not word & 0x8000:
+        return (True, word, None, False, False, False, False, 0)
+
+    code = (word >> 6) & 0x7F
+    if code not in COMP_CODES:
+        raise ValueError(f'invalid comp bits in instruction {word:016b}.')
+
+    comp = COMP_CODES[code]
+    return (
+        False,
+        0,
+        COMP_FUNCTIONS[comp],
+        'M' in comp,
+        bool(word & 0b100000),
+        bool(word & 0b010000),
+        bool(word & 0b001000),
+        word & 0b111,
+    )
+
+
+def find_halt_loops(rom):
+    # Addresses of `(X) @X 0;JMP` loops, which is how Hack programs stop.
+    return {
+        address
+        for address in range(len(rom) - 1)
+        if rom[address] == address and rom[address + 1] & 0xE03F == 0xE007
+    }
+
+
+class Emulator:
+    # Runs a Hack program image. Every instruction is decoded once when the
+    # program is loaded, and the RAM is a flat array of unsigned words.
+    def __init__(self, rom):
+        self.rom = array('H', rom)
+        self.program = [decode(word) for word in self.rom]
+        self.halt_loops = find_halt_loops(self.rom)
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.reset()
+
+    def reset(self):
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def run(self, max_cycles):
+        # Executes at most max_cycles instructions and returns the number
+        # executed. Stops early when the program halts.
+        program = self.program
+        halt_loops = self.halt_loops
+        size = len(program)
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+        cycles = 0
+
+        while cycles < max_cycles:
+            if pc >= size:
+                self.halted = True
+                break
+
+            is_a, value, comp, uses_m, dest_a, dest_d, dest_m, jump = program[pc]
+            cycles += 1
+
+            if is_a:
+                a = value
+                pc += 1
+                continue
+
+            out = comp(a, d, ram[a] if uses_m else 0)
+
+            # Jump bits are j1 (out < 0), j2 (out = 0) and j3 (out > 0).
+            if jump and jump & (0b100 if out & 0x8000 else 0b010 if out == 0 else 0b001):
+                if jump == 0b111 and a in halt_loops:
+                    pc = a
+                    self.halted = True
+                    break
+                pc = a
+            else:
+                pc += 1
+
+            if dest_m:
+                ram[a] = out
+            if dest_d:
+                d = out
+            if dest_a:
+                a = out
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        return cycles
+
+
+def find_leaders(rom, labels=()):
+    # Addresses that start a basic block: the entry point, every label,
+    # every constant jump target and every instruction following a jump.
+    leaders = {0, *labels}
+    for address, word in enumerate(rom):
+        if word & 0x8000 and word & 0b111:
+            leaders.add(address + 1)
+            if address > 0 and not rom[address - 1] & 0x8000:
+                leaders.add(rom[address - 1])
+    return leaders
+
+
+def translate_comp(word):
+    return re.sub(r'\bm\b', 'ram[a]', COMP_EXPRESSIONS[COMP_CODES[(word >> 6) & 0x7F]])
+
+
+def translate_dest(word):
+    # Registers written by a C-instruction, with M first since it is
+    # addressed by the old value of A.
+    targets = []
+    if word & 0b001000:
+        targets.append('ram[a]')
+    if word & 0b010000:
+        targets.append('d')
+    if word & 0b100000:
+        targets.append('a')
+    return targets
+
+
+def translate_block(rom, start, leaders):
+    # Generates the source of a function that runs the basic block at
+    # `start` and returns (a, d, next_pc), along with its length. A block
+    # ends after a jump or before the next leader.
+    lines = ['def block(ram, a, d):']
+    address = start
+
+    while address < len(rom):
+        word = rom[address]
+        address += 1
+
+        if not word & 0x8000:
+            lines.append(f'    a = {word}')
+        elif word & 0b111:
+            lines.append('    target = a')
+            lines.append(f'    out = {translate_comp(word)}')
+            lines.extend(f'    {target} = out' for target in translate_dest(word))
+            lines.append(f'    if {JUMP_CONDITIONS[word & 0b111]}:')
+            lines.append('        return a, d, target')
+            lines.append(f'    return a, d, {address}')
+            return '\n'.join(lines), address - start
+        else:
+            targets = translate_dest(word)
+            if len(targets) == 1:
+                lines.append(f'    {targets[0]} = {translate_comp(word)}')
+            elif targets:
+                lines.append(f'    out = {translate_comp(word)}')
+                lines.extend(f'    {target} = out' for target in targets)
+
+        if address in leaders:
+            break
+
+    lines.append(f'    return a, d, {address}')
+    return '\n'.join(lines), address - start
+
+
+class BlockEmulator(Emulator):
+    # Runs a program as basic blocks translated into Python functions. A
+    # block is compiled the first time control reaches its address and is
+    # cached, so straight-line code runs without per-instruction dispatch.
+    # Runs can overshoot max_cycles by up to one block, and stop as soon as
+    # control reaches a halt loop. With profile set, every block execution
+    # is counted, which is enough to recover per-address counts since all
+    # instructions of a block run each time it is entered.
+    def __init__(self, rom, labels=(), profile=False):
+        super().__init__(rom)
+        self.leaders = find_leaders(self.rom, labels)
+        # One slot per addressable ROM word, so that any jump target can be
+        # looked up directly. Halt loops are never compiled.
+        self.blocks = [None] * 0x10000
+        self.block_hits = array('Q', bytes(8 * 0x10000)) if profile else None
+
+    def compile_block(self, start):
+        source, length = translate_block(self.rom, start, self.leaders)
+        namespace = {}
+        exec(compile(source, f'<block {start}>', 'exec'), namespace)
+        self.blocks[start] = (namespace['block'], length)
+        return self.blocks[start]
+
+    def run(self, max_cycles):
+        blocks = self.blocks
+        block_hits = self.block_hits
+        halt_loops = self.halt_loops
+        size = len(self.rom)
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+        cycles = 0
+
+        while cycles < max_cycles:
+            block = blocks[pc]
+            if block is None:
+                if pc >= size or pc in halt_loops:
+                    self.halted = True
+                    break
+                block = self.compile_block(pc)
+
+            if block_hits is not None:
+                block_hits[pc] += 1
+            a, d, pc = block[0](ram, a, d)
+            cycles += block[1]
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        return cycles
+
+    def address_hits(self):
+        # Number of times each ROM address was executed.
+        hits = array('Q', bytes(8 * len(self.rom)))
+        for start, count in enumerate(self.block_hits):
+            if count:
+                for address in range(start, start + self.blocks[start][1]):
+                    hits[address] += count
+        return hits
+
+
+def function_of(label):
+    # The VM function a label belongs to, given the names CodeWriter emits:
+    # `f$label` for labels inside f and `f.return-address.n` for returns.
+    # The shared routines are named `$NAME`, with `$NAME-END` inside them.
+    if label.startswith('$'):
+        return label.split('-')[0]
+    return label.split('$')[0].split('.return-address.')[0]
+
+
+def aggregate_hits(hits, labels):
+    # Sums the hits of every address into the nearest label at or before it.
+    # Of several labels at one address the last one sorted is used, and
+    # return addresses sort first: a call that never returns, like the
+    # bootstrap's, leaves its return label on whatever code follows.
+    entries = sorted(
+        (address, '.return-address.' not in name, name)
+        for name, address in labels.items()
+    )
+    addresses = [address for address, _, _ in entries]
+
+    counts = {}
+    for address, count in enumerate(hits):
+        if not count:
+            continue
+        index = bisect_right(addresses, address) - 1
+        name = entries[index][2] if index >= 0 else '<start>'
+        counts[name] = counts.get(name, 0) + count
+
+    return counts
+
+
+def print_profile(title, counts, limit):
+    total = sum(counts.values()) or 1
+    cumulative = 0
+
+    print(f'\n{title}')
+    print(f'{"self %":>8} {"cum %":>8} {"count":>14}  name')
+    for name, count in sorted(counts.items(), key=lambda item: -item[1])[:limit]:
+        cumulative += count
+        print(f'{100 * count / total:8.2f} {100 * cumulative / total:8.2f} '
+              f'{count:14d}  {name}')
+
+
+def read_labels(filepath, mappath=None):
+    # Label addresses from a .map file, or from the source of an .asm file.
+    if mappath is not None:
+        return read_symbol_map(mappath)[0]
+
+    labels = {}
+    if os.path.splitext(filepath)[1] == '.asm':
+        with open(filepath, 'r') as prog:
+            scan_labels(prog, labels)
+    return {name: int(address) for name, address in labels.items()}
+
+
+def parse_assignment(text):
+    address, value = text.split('=')
+    return int(address), int(value) & 0xFFFF
+
+
+def parse_range(text):
+    start, end = text.split(':')
+    return int(start), int(end)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Run a Hack program.')
+    parser.add_argument('program', help='an .asm file, or a text or packed '
+                        'binary .hack file')
+    parser.add_argument('-n', '--cycles', type=int, default=10 ** 8,
+                        help='maximum number of instructions to execute')
+    parser.add_argument('--set', type=parse_assignment, action='append',
+                        default=[], metavar='ADDR=VALUE',
+                        help='set a RAM word before running')
+    parser.add_argument('--blocks', action='store_true',
+                        help='translate basic blocks into Python functions '
+                        'instead of interpreting instruction by instruction')
+    parser.add_argument('--map', help='a .map file whose labels also start '
+                        'basic blocks')
+    parser.add_argument('--profile', type=int, nargs='?', const=20,
+                        metavar='ROWS', help='count executions per ROM '
+                        'address (implies --blocks) and print the hottest '
+                        'labels and functions')
+    parser.add_argument('--dump', type=parse_range, metavar='START:END',
+                        help='print RAM[START:END] after running')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    rom = read_program(args.program)
+    if args.blocks or args.profile is not None:
+        labels = read_labels(args.program, args.map)
+        emulator = BlockEmulator(rom, labels.values(), args.profile is not None)
+    else:
+        emulator = Emulator(rom)
+    for address, value in args.set:
+        emulator.ram[address] = value
+
+    start = time.perf_counter()
+    cycles = emulator.run(args.cycles)
+    elapsed = time.perf_counter() - start
+
+    state = 'halted' if emulator.halted else 'stopped'
+    print(f'{state} at pc={emulator.pc} after {cycles} instructions in '
+          f'{elapsed:.3f} s ({cycles / max(elapsed, 1e-9):,.0f} instructions/s)')
+
+    if args.profile is not None:
+        counts = aggregate_hits(emulator.address_hits(), labels)
+        functions = {}
+        for name, count in counts.items():
+            function = function_of(name)
+            functions[function] = functions.get(function, 0) + count
+
+        print_profile('Flat profile by label:', counts, args.profile)
+        print_profile('Profile by function:', functions, args.profile)
+
+    if args.dump is not None:
+        start, end = args.dump
+        for address in range(start, end):
+            print(f'RAM[{address}] = {emulator.ram[address]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+from functools import partial
+
 SEGMENT_POINTERS = {
     'local': 'LCL',
     'argument': 'ARG',
@@ -12,6 +14,31 @@ class CodeWriter:
         self._labelCounter = 0
         self.fileName = None
 
+        # Dispatch tables from VM command / (command, segment) to emitter.
+        self._arithmeticEmitters = {
+            'add': self._add,
+            'sub': self._sub,
+            'neg': self._neg,
+            'eq': self._eq,
+            'gt': self._gt,
+            'lt': self._lt,
+            'and': self._and,
+            'or': self._or,
+            'not': self._not,
+        }
+        self._pushPopEmitters = {
+            ('push', 'constant'): self._pushConstant,
+            ('push', 'temp'): self._pushTemp,
+            ('pop', 'temp'): self._popTemp,
+            ('push', 'pointer'): self._pushPointer,
+            ('pop', 'pointer'): self._popPointer,
+            ('push', 'static'): self._pushStatic,
+            ('pop', 'static'): self._popStatic,
+        }
+        for segment in ['local', 'argument', 'this', 'that']:
+            self._pushPopEmitters['push', segment] = partial(self._pushGeneric, segment)
+            self._pushPopEmitters['pop', segment] = partial(self._popGeneric, segment)
+
     def setFileName(self, fileName):
         self.fileName = fileName
 
@@ -129,28 +156,10 @@ class CodeWriter:
     def writeArithmetic(self, command):
         self._write(rf'// {command}')
 
-        if command == 'add':
-            return self._add()
-        if command == 'sub':
-            return self._sub()
-        if command == 'neg':
-            return self._neg()
-
-        if command == 'eq':
-            return self._eq()
-        if command == 'gt':
-            return self._gt()
-        if command == 'lt':
-            return self._lt()
-
-        if command == 'and':
-            return self._and()
-        if command == 'or':
-            return self._or()
-        if command == 'not':
-            return self._not()
-
-        raise ValueError('invalid command.')
+        emitter = self._arithmeticEmitters.get(command)
+        if emitter is None:
+            raise ValueError('invalid command.')
+        return emitter()
 
     def _getSegmentPointer(self, segment):
         return SEGMENT_POINTERS[segment]
@@ -175,12 +184,6 @@ class CodeWriter:
 
         self._popFromStackToAddressInDRegister()
 
-    def _pushPopGeneric(self, command, segment, index):
-        if command == 'push':
-            return self._pushGeneric(segment, index)
-        if command == 'pop':
-            return self._popGeneric(segment, index)
-
     # === Temp ===
     def _pushTemp(self, index):
         self._write(f"@5")
@@ -199,12 +202,6 @@ class CodeWriter:
 
         self._popFromStackToAddressInDRegister()
 
-    def _pushPopTemp(self, command, index):
-        if command == 'push':
-            return self._pushTemp(index)
-        if command == 'pop':
-            return self._popTemp(index)
-
     # === Constant ===
     def _pushConstant(self, index):
         self._write(f"@{index}")
@@ -224,12 +221,6 @@ class CodeWriter:
         self._write(f"D=A")
         self._popFromStackToAddressInDRegister()
 
-    def _pushPopPointer(self, command, index):
-        if command == 'push':
-            return self._pushPointer(index)
-        if command == 'pop':
-            return self._popPointer(index)
-
     # === Static ===
     def _pushStatic(self, index):
         varName = f"{self.fileName}.{index}"
@@ -243,23 +234,10 @@ class CodeWriter:
         self._write("D=A")
         self._popFromStackToAddressInDRegister()
 
-    def _pushPopStatic(self, command, index):
-        if command == 'push':
-            return self._pushStatic(index)
-        if command == 'pop':
-            return self._popStatic(index)
-
     def writePushPop(self, command, segment, index):
         self._write(rf'// {command} {segment} {index}')
 
-        if segment in ['local', 'argument', 'this', 'that']:
-            return self._pushPopGeneric(command, segment, index)
-        if segment == 'constant':
-            return self._pushConstant(index)
-        if segment == 'temp':
-            return self._pushPopTemp(command, index)
-        if segment == 'pointer':
-            return self._pushPopPointer(command, index)
-        if segment == 'static':
-            return self._pushPopStatic(command, index)
-
+        emitter = self._pushPopEmitters.get((command, segment))
+        if emitter is None:
+            raise ValueError('invalid segment.')
+        return emitter(index)
@@ -1,61 +1,191 @@
-import sys
+import io
 import os
 import pathlib
 import glob
+import argparse
+from collections import Counter
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 from parser import Parser, CommandType
-from codewriter import CodeWriter
+from codewriter import CodeWriter, countInstructions, callReturnCycles
+from optimizer import RULES, optimize
+from linker import link
 
 
-def writeBootstrapCode(outputStream):
-    codewriter = CodeWriter(outputStream)
+# One emitter per command type, each writing that command through a
+# CodeWriter. The EMITTERS table replaces an if-chain to keep dispatch in
+# one place; it is not a speedup, as choosing the emitter is no measurable
+# part of the translation time, which goes to writing the lines.
+def emitArithmetic(codewriter, command):
+    codewriter.writeArithmetic(command.arg1)
+
+
+def emitPush(codewriter, command):
+    codewriter.writePushPop('push', command.arg1, command.arg2)
+
+
+def emitPop(codewriter, command):
+    codewriter.writePushPop('pop', command.arg1, command.arg2)
+
+
+def emitLabel(codewriter, command):
+    codewriter.writeLabel(command.arg1)
+
+
+def emitGoto(codewriter, command):
+    codewriter.writeGoto(command.arg1)
+
+
+def emitIf(codewriter, command):
+    codewriter.writeIf(command.arg1)
+
+
+def emitCall(codewriter, command):
+    codewriter.writeCall(command.arg1, command.arg2)
+
+
+def emitReturn(codewriter, command):
+    codewriter.writeReturn()
+
+
+def emitFunction(codewriter, command):
+    codewriter.writeFunction(command.arg1, command.arg2)
+
+
+def emitMove(codewriter, command):
+    codewriter.writeMove(command.arg1, command.arg2)
+
+
+def emitEqualsZero(codewriter, command):
+    codewriter.writeEqualsZero()
+
+
+def emitIfNot(codewriter, command):
+    codewriter.writeIfNot(command.arg1)
+
+
+EMITTERS = {
+    CommandType.C_ARITHMETIC: emitArithmetic,
+    CommandType.C_PUSH: emitPush,
+    CommandType.C_POP: emitPop,
+    CommandType.C_LABEL: emitLabel,
+    CommandType.C_GOTO: emitGoto,
+    CommandType.C_IF: emitIf,
+    CommandType.C_CALL: emitCall,
+    CommandType.C_RETURN: emitReturn,
+    CommandType.C_FUNCTION: emitFunction,
+    CommandType.C_MOVE: emitMove,
+    CommandType.C_EQ_ZERO: emitEqualsZero,
+    CommandType.C_IF_NOT: emitIfNot,
+}
+
+
+def writeBootstrapCode(outputStream, **options):
+    codewriter = CodeWriter(outputStream, **options)
     codewriter.writeInit()
+    codewriter.flush()
+
+
+def writeSharedRoutines(outputStream, **options):
+    codewriter = CodeWriter(outputStream, **options)
+    codewriter.writeHalt()
+    codewriter.writeSharedRoutines()
+    codewriter.flush()
+
+
+def readCommands(inputFileName):
+    with open(inputFileName, 'r') as inputStream:
+        return list(Parser(inputStream))
 
 
-def assemble(inputFileName, outputStream):
+def translate(inputFileName, commands, outputStream, hits=None, **options):
     # Instantiate codewriter.
-    codewriter = CodeWriter(outputStream)
+    codewriter = CodeWriter(outputStream, **options)
     codewriter.setFileName(pathlib.Path(inputFileName).stem)
 
-    with open(inputFileName, 'r') as inputStream:
-        parser = Parser(inputStream)
+    # Optimizing needs the whole file; `hits` collects the rule counts.
+    if hits is not None:
+        commands = optimize(commands, hits)
 
-        while parser.hasMoreCommands():
-            parser.advance() 
-            if parser.commandType() == CommandType.C_ARITHMETIC:
-                codewriter.writeArithmetic(parser.arg1())
+    for command in commands:
+        EMITTERS[command.commandType](codewriter, command)
 
-            if parser.commandType() == CommandType.C_PUSH:
-                codewriter.writePushPop('push', parser.arg1(), parser.arg2())
+    codewriter.flush()
 
-            if parser.commandType() == CommandType.C_POP:
-                codewriter.writePushPop('pop', parser.arg1(), parser.arg2())
-            
-            if parser.commandType() == CommandType.C_LABEL:
-                codewriter.writeLabel(parser.arg1())
 
-            if parser.commandType() == CommandType.C_GOTO:
-                codewriter.writeGoto(parser.arg1())
+def translateToString(inputFileName, commands, optimizing=False, **options):
+    # Translates one file on its own, as a --jobs worker. Returns the text,
+    # the labels it defines and the optimizer rule hits.
+    labels = set()
+    hits = Counter() if optimizing else None
+    outputStream = io.StringIO()
+    translate(inputFileName, commands, outputStream, hits, labels=labels, **options)
+    return outputStream.getvalue(), labels, hits
 
-            if parser.commandType() == CommandType.C_IF:
-                codewriter.writeIf(parser.arg1())
 
-            if parser.commandType() == CommandType.C_CALL:
-                codewriter.writeCall(parser.arg1(), parser.arg2())
+def translateParallel(programs, outputStream, jobs, hits=None, labels=None, **options):
+    # Files are translated in parallel but written in the order of
+    # `programs`, so the output is the same as translating them one by one.
+    translateFile = partial(translateToString, optimizing=hits is not None, **options)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(translateFile, programs.keys(), programs.values()))
 
-            if parser.commandType() == CommandType.C_RETURN:
-                codewriter.writeReturn()
+    for inputFileName, (text, fileLabels, fileHits) in zip(programs, results):
+        print(f"Assembling {inputFileName}")
 
-            if parser.commandType() == CommandType.C_FUNCTION:
-                codewriter.writeFunction(parser.arg1(), parser.arg2())
+        if labels is not None:
+            duplicates = labels & fileLabels
+            if duplicates:
+                raise ValueError(f'duplicate label: {min(duplicates)}')
+            labels |= fileLabels
+        if hits is not None:
+            hits.update(fileHits)
 
+        outputStream.write(text)
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        raise ValueError('invalid number of arguments provided.')
+def countDroppedInstructions(dropped, hits, **options):
+    # Translates the dropped functions on their own, to count the
+    # instructions they would have taken.
+    options = {**options, 'release': True, 'labels': set()}
+    hits = None if hits is None else Counter()
+
+    outputStream = io.StringIO()
+    for inputFileName, commands in dropped.items():
+        translate(inputFileName, commands, outputStream, hits, **options)
+    return countInstructions(outputStream.getvalue().splitlines())
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Translate VM code into Hack assembly.')
+    parser.add_argument('input', help='a .vm file, or a directory of .vm files')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='fuse common VM command pairs before translating')
+    parser.add_argument('--release', action='store_true',
+                        help='omit comments and indentation from the output')
+    parser.add_argument('--cache-top', action='store_true',
+                        help='keep the top of the stack in D between commands')
+    parser.add_argument('--shared-calls', action='store_true',
+                        help='emit call and return as jumps to one shared '
+                        'routine each, trading cycles for ROM size')
+    parser.add_argument('--shared-comparisons', action='store_true',
+                        help='emit eq, gt and lt as jumps to one shared '
+                        'routine each, trading cycles for ROM size')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files to translate in parallel '
+                        '(default: 1)')
+    parser.add_argument('--keep-unused', action='store_true',
+                        help='when translating a directory, keep functions '
+                        'that Sys.init can never reach')
+    return parser.parse_args(argv)
 
-    inputArgument = sys.argv[1]
+
+def main(argv=None):
+    args = parseArgs(argv)
+
+    inputArgument = args.input
     if os.path.isfile(inputArgument):
         if pathlib.Path(inputArgument).suffix != '.vm':
             raise ValueError('invalid filetype of input file.')
@@ -63,7 +193,7 @@ if __name__ == "__main__":
         outputFileName = inputArgument.replace('.vm', '.asm')
         writeBootstrap = False
     elif os.path.isdir(inputArgument):
-        inputFiles = glob.glob(os.path.join(inputArgument, '*.vm'))
+        inputFiles = sorted(glob.glob(os.path.join(inputArgument, '*.vm')))
         mainFileName = os.path.basename(os.path.normpath(inputArgument))
         outputFileName = os.path.join(inputArgument, f'{mainFileName}.asm')
         writeBootstrap = True
@@ -71,12 +201,66 @@ if __name__ == "__main__":
     print(f"Input files: {inputFiles}")
     print(f"Output files: {outputFileName}")
 
+    options = {
+        'release': args.release,
+        'sharedCalls': args.shared_calls,
+        'sharedComparisons': args.shared_comparisons,
+        'cacheTop': args.cache_top,
+    }
+    # Labels of the whole output file, checked for collisions.
+    labels = set()
+
+    hits = Counter() if args.optimize else None
+
+    programs = {
+        inputFileName: readCommands(inputFileName) for inputFileName in inputFiles
+    }
+    dropped = {}
+    if writeBootstrap and not args.keep_unused:
+        programs, dropped = link(programs)
+
     with open(outputFileName, 'w') as outputStream:
         if writeBootstrap:
             print("Generating bootstrap code.")
-            writeBootstrapCode(outputStream)
+            writeBootstrapCode(outputStream, labels=labels, **options)
+
+        if args.jobs > 1:
+            translateParallel(programs, outputStream, args.jobs, hits, labels,
+                              **options)
+        else:
+            for inputFileName, commands in programs.items():
+                print(f"Assembling {inputFileName}")
+                translate(inputFileName, commands, outputStream, hits,
+                          labels=labels, **options)
 
-        for inputFileName in inputFiles:
-            print(f"Assembling {inputFileName}")
-            assemble(inputFileName, outputStream)
+        # Without a bootstrap, the shared routines go after the program, behind
+        # a halt loop.
+        if (args.shared_calls or args.shared_comparisons) and not writeBootstrap:
+            writeSharedRoutines(outputStream, labels=labels, **options)
 
+    with open(outputFileName, 'r') as outputStream:
+        print(f"ROM size: {countInstructions(outputStream)} instructions")
+
+    if dropped:
+        functions = sum(
+            command.commandType == CommandType.C_FUNCTION
+            for commands in dropped.values() for command in commands
+        )
+        saved = countDroppedInstructions(dropped, hits, **options)
+        print(f"Removed {functions} unused functions, saving {saved} "
+              f"instructions ({2 * saved} bytes of ROM)")
+
+    if args.optimize:
+        print("Optimizer rule hits:")
+        for name, rule in RULES:
+            print(f"  {name}: {hits[name]}")
+
+    if args.shared_calls:
+        callCycles, returnCycles = callReturnCycles(sharedCalls=True)
+        inlineCallCycles, inlineReturnCycles = callReturnCycles()
+        print(f"Call: {callCycles} cycles (inline: {inlineCallCycles}), "
+              f"return: {returnCycles} cycles (inline: {inlineReturnCycles})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-import random
+import io
+from functools import partial
 
 SEGMENT_POINTERS = {
     'local': 'LCL',
@@ -7,11 +8,66 @@ SEGMENT_POINTERS = {
     'that': 'THAT',
 }
 
+# Buffered lines are flushed to the stream once the buffer holds this many.
+FLUSH_LINES = 4096
+
+# Entry points of the routines shared by all call sites in sharedCalls mode.
+CALL_ROUTINE = '$CALL'
+RETURN_ROUTINE = '$RETURN'
+
+# Functions with more locals than this zero them in a loop instead of one
+# instruction pair per local.
+LOCALS_LOOP_THRESHOLD = 8
+
+# Generic segment entries up to this index are stored from D by stepping A,
+# instead of through a scratch register.
+STORE_STEP_LIMIT = 6
+
+# Loop that keeps a program without bootstrap out of the shared routines.
+HALT_LABEL = '$HALT'
+
+# Jump condition -> entry point of its shared routine in sharedComparisons mode.
+COMPARISON_ROUTINES = {
+    'JEQ': '$EQ',
+    'JGT': '$GT',
+    'JLT': '$LT',
+}
+
 BOOLEANS = {
     'true': -1,
     'false': 0,
 }
 
+def countInstructions(lines):
+    # Number of lines that are neither blank, labels nor comments.
+    count = 0
+    for line in lines:
+        line = line.strip()
+        if line and line[0] != '(' and not line.startswith('//'):
+            count += 1
+    return count
+
+
+def callReturnCycles(**options):
+    # Instructions executed by one call and by one return, including any
+    # shared routine. Neither sequence branches, so these are cycle counts.
+    codewriter = CodeWriter(io.StringIO(), **{**options, 'release': True})
+    codewriter._currentFunction = 'f'
+
+    def cost(emit):
+        emit()
+        count = countInstructions(codewriter._buffer)
+        codewriter._buffer.clear()
+        return count
+
+    callCycles = cost(lambda: codewriter.writeCall('g', 0))
+    returnCycles = cost(codewriter.writeReturn)
+    if codewriter.sharedCalls:
+        callCycles += cost(codewriter._writeCallRoutine)
+        returnCycles += cost(codewriter._writeReturnRoutine)
+    return callCycles, returnCycles
+
+
 class CodeWriterGenericOperations:
     def __init__(self, write):
         self.write = write
@@ -54,62 +110,96 @@ class CodeWriterGenericOperations:
 
 
 class CodeWriter:
-    def __init__(self, stream):
+    def __init__(self, stream, release=False, labels=None, sharedCalls=False,
+                 sharedComparisons=False, cacheTop=False):
         self.stream = stream
-        self._labelCounter = 0
+        self.release = release
+        self.sharedCalls = sharedCalls
+        self.sharedComparisons = sharedComparisons
+        self.cacheTop = cacheTop
+        # In cacheTop mode, whether the top of the stack is held in D instead
+        # of memory. It is written back before labels, jumps, calls and
+        # returns, so every jump target starts with the stack in memory.
+        self._topInD = False
+        # Generated and defined labels. Writers of one program share this set
+        # to catch collisions across files.
+        self.labels = set() if labels is None else labels
+        self._labelCounters = {}
         self.fileName = None
-        self._genericops = CodeWriterGenericOperations(self._write)
         self._currentFunction = None
         self._indent = 0
+        self._buffer = []
+
+        # Release builds carry no indentation or comments, so lines go
+        # straight into the buffer.
+        if release:
+            self._write = self._buffer.append
+            self._writeComment = lambda comment: None
+
+        self._genericops = CodeWriterGenericOperations(self._write)
+
+        # Dispatch tables from VM command / (command, segment) to emitter.
+        self._arithmeticEmitters = {
+            'add': self._add,
+            'sub': self._sub,
+            'neg': self._neg,
+            'eq': self._eq,
+            'gt': self._gt,
+            'lt': self._lt,
+            'and': self._and,
+            'or': self._or,
+            'not': self._not,
+        }
+        self._pushPopEmitters = {
+            ('push', 'constant'): self._pushConstant,
+            ('push', 'temp'): self._pushTemp,
+            ('pop', 'temp'): self._popTemp,
+            ('push', 'pointer'): self._pushPointer,
+            ('pop', 'pointer'): self._popPointer,
+            ('push', 'static'): self._pushStatic,
+            ('pop', 'static'): self._popStatic,
+        }
+        for segment in SEGMENT_POINTERS:
+            self._pushPopEmitters['push', segment] = partial(self._pushGeneric, segment)
+            self._pushPopEmitters['pop', segment] = partial(self._popGeneric, segment)
+
+        if cacheTop:
+            self._arithmeticEmitters.update({
+                'add': partial(self._cachedBinary, "D=D+M"),
+                'sub': partial(self._cachedBinary, "D=M-D"),
+                'and': partial(self._cachedBinary, "D=D&M"),
+                'or': partial(self._cachedBinary, "D=D|M"),
+                'neg': partial(self._cachedUnary, "D=-D", self._neg),
+                'not': partial(self._cachedUnary, "D=!D", self._not),
+            })
+            for command, segment in self._pushPopEmitters:
+                emitter = self._cachedPush if command == 'push' else self._cachedPop
+                self._pushPopEmitters[command, segment] = partial(emitter, segment)
 
     # ===== Public methods =============================================================
     def setFileName(self, fileName):
         self.fileName = fileName
-        self._write(f"// === {fileName} =====")
+        self._writeComment(f"=== {fileName} =====")
         self._indent = 1
 
     def writeArithmetic(self, command):
-        self._write(rf'// {command}')
-
-        if command == 'add':
-            return self._add()
-        if command == 'sub':
-            return self._sub()
-        if command == 'neg':
-            return self._neg()
-
-        if command == 'eq':
-            return self._eq()
-        if command == 'gt':
-            return self._gt()
-        if command == 'lt':
-            return self._lt()
-
-        if command == 'and':
-            return self._and()
-        if command == 'or':
-            return self._or()
-        if command == 'not':
-            return self._not()
-
-        raise ValueError('invalid command.')
+        self._writeComment(command)
+
+        emitter = self._arithmeticEmitters.get(command)
+        if emitter is None:
+            raise ValueError('invalid command.')
+        return emitter()
 
     def writePushPop(self, command, segment, index):
-        self._write(rf'// {command} {segment} {index}')
+        self._writeComment(f'{command} {segment} {index}')
 
-        if segment in ['local', 'argument', 'this', 'that']:
-            return self._pushPopGeneric(command, segment, index)
-        if segment == 'constant':
-            return self._pushConstant(index)
-        if segment == 'temp':
-            return self._pushPopTemp(command, index)
-        if segment == 'pointer':
-            return self._pushPopPointer(command, index)
-        if segment == 'static':
-            return self._pushPopStatic(command, index)
+        emitter = self._pushPopEmitters.get((command, segment))
+        if emitter is None:
+            raise ValueError('invalid segment.')
+        return emitter(index)
 
     def writeInit(self):
-        self._write("// Bootstrap code")
+        self._writeComment("Bootstrap code")
         self._currentFunction = "bootstrap"
         self._indent = 1
 
@@ -121,34 +211,48 @@ class CodeWriter:
         # Call Sys.init.
         self.writeCall("Sys.init", 0)
 
+        # Sys.init never returns, so the shared routines can follow the call.
+        self.writeSharedRoutines()
+
         self._currentFunction = None
         self._indent = 0
 
     def writeLabel(self, label):
-        self._write(rf'// label {label}')
+        self._writeComment(f'label {label}')
+        self._spillTop()
 
         funcLabel = self._getFunctionLabel(label)
+        self._defineLabel(funcLabel)
         self._write(f"({funcLabel})")
 
     def writeGoto(self, label):
-        self._write(rf'// goto {label}')
+        self._writeComment(f'goto {label}')
+        self._spillTop()
 
         funcLabel = self._getFunctionLabel(label)
         self._write(f"@{funcLabel}")
         self._write("0;JMP")
 
     def writeIf(self, label):
-        self._write(rf'// if-goto {label}')
+        self._writeComment(f'if-goto {label}')
 
         funcLabel = self._getFunctionLabel(label)
-        self._genericops.popFromStackToDRegister()
+        if self.cacheTop:
+            self._fillTop()
+            self._topInD = False
+        else:
+            self._genericops.popFromStackToDRegister()
         self._write(f"@{funcLabel}")
         self._write("D;JNE")
 
     def writeCall(self, functionName, numArgs):
-        self._write(rf'// call {functionName} {numArgs}')
+        self._writeComment(f'call {functionName} {numArgs}')
+        self._spillTop()
 
         returnAddr = self._getFunctionReturnLabel()
+        if self.sharedCalls:
+            return self._writeSharedCall(functionName, numArgs, returnAddr)
+
         self._write(f"@{returnAddr}")
         self._write("D=A")
         self._genericops.pushFromDRegisterToStack()
@@ -179,7 +283,13 @@ class CodeWriter:
         self._write(f"({returnAddr})")
 
     def writeReturn(self):
-        self._write(rf'// return')
+        self._writeComment('return')
+        self._spillTop()
+
+        if self.sharedCalls:
+            self._write(f"@{RETURN_ROUTINE}")
+            self._write("0;JMP")
+            return
 
         def repositionLabelFromFrameOffset(address, offset):
             self._write(f"@{offset}")
@@ -217,17 +327,118 @@ class CodeWriter:
         self._write("0;JMP")
 
     def writeFunction(self, functionName, numLocals):
-        self._write(rf'// function {functionName} {numLocals}')
+        if len(self._buffer) >= FLUSH_LINES:
+            self.flush()
+
+        self._writeComment(f'function {functionName} {numLocals}')
+        self._spillTop()
         self._currentFunction = functionName
 
+        self._defineLabel(functionName)
         self._write(f"({functionName})")
-        for k in range(numLocals):
-            self.writePushPop("push", "constant", 0)
+        if numLocals > LOCALS_LOOP_THRESHOLD:
+            self._writeLocalsLoop(numLocals)
+        elif numLocals:
+            self._writeLocals(numLocals)
+
+    def writeMove(self, source, destination):
+        sourceSegment, sourceIndex = source
+        destinationSegment, destinationIndex = destination
+        self._writeComment(f'push {sourceSegment} {sourceIndex}; '
+                           f'pop {destinationSegment} {destinationIndex}')
+        self._spillTop()
+
+        address = self._getDirectAddress(destinationSegment, destinationIndex)
+        if address is not None or destinationIndex <= STORE_STEP_LIMIT:
+            self._loadSegment(sourceSegment, sourceIndex)
+            self._storeSegment(destinationSegment, destinationIndex)
+            return
+
+        if destinationSegment not in SEGMENT_POINTERS:
+            raise ValueError('invalid segment.')
+
+        # R13 = destination address
+        segmentPointer = self._getSegmentPointer(destinationSegment)
+        self._write(f"@{segmentPointer}")
+        self._write("D=M")
+        self._write(f"@{destinationIndex}")
+        self._write("D=D+A")
+        self._genericops.changeAddressToDRegister("R13")
+
+        self._loadSegment(sourceSegment, sourceIndex)
+        self._genericops.pushFromDRegisterToAddress("R13")
+
+    def writeEqualsZero(self):
+        self._writeComment('push constant 0; eq')
+
+        scope = self._currentFunction or self.fileName
+        if self.cacheTop:
+            self._fillTop()
+            return self._cachedBoolean("JEQ", scope)
+
+        endLabel = self._newLabel(f"{scope}$END_OF_CMD-")
+
+        # Replace the top of the stack with true, then with false unless it
+        # was zero.
+        self._write("@SP")
+        self._write("A=M-1")
+        self._write("D=M")
+        self._write(f"M={BOOLEANS['true']}")
+        self._write(f"@{endLabel}")
+        self._write("D;JEQ")
+        self._write("@SP")
+        self._write("A=M-1")
+        self._write(f"M={BOOLEANS['false']}")
+        self._write(f"({endLabel})")
+
+    def writeIfNot(self, label):
+        self._writeComment(f'not; if-goto {label}')
+
+        # not x is nonzero exactly when x + 1 is.
+        funcLabel = self._getFunctionLabel(label)
+        if self._topInD:
+            self._write("D=D+1")
+            self._topInD = False
+        else:
+            self._write("@SP")
+            self._write("AM=M-1")
+            self._write("D=M+1")
+        self._write(f"@{funcLabel}")
+        self._write("D;JNE")
+
+    def writeHalt(self):
+        self._writeComment("Halt")
+        self._defineLabel(HALT_LABEL)
+        self._write(f"({HALT_LABEL})")
+        self._write(f"@{HALT_LABEL}")
+        self._write("0;JMP")
+
+    def writeSharedRoutines(self):
+        if self.sharedCalls:
+            self._writeComment("Shared call and return routines")
+            self._writeCallRoutine()
+            self._writeReturnRoutine()
+
+        if self.sharedComparisons:
+            self._writeComment("Shared comparison routines")
+            for jumpCommand in COMPARISON_ROUTINES:
+                self._writeComparisonRoutine(jumpCommand)
+
+    def flush(self):
+        # Writes out all the writer still holds: a cached stack top, then the
+        # buffered lines.
+        self._spillTop()
+        if self._buffer:
+            self._buffer.append('')
+            self.stream.write('\n'.join(self._buffer))
+            self._buffer.clear()
 
     # === Private methods ==============================================================
     def _write(self, line):
-        indent = "    " * self._indent
-        self.stream.write(indent + line + '\n')
+        self._buffer.append("    " * self._indent + line)
+
+    def _writeComment(self, comment):
+        self._write(f"// {comment}")
 
     def _add(self):
         self._genericops.popFromStackToDRegister()
@@ -235,7 +446,7 @@ class CodeWriter:
         # Replace stack element with sum.
         self._write("@SP")
         self._write("A=M-1")
-        self._write("M=M+D")
+        self._write("M=D+M")
 
     def _sub(self):
         self._genericops.popFromStackToDRegister()
@@ -251,14 +462,22 @@ class CodeWriter:
         self._write("M=-M")
 
     def _comparisonTemplate(self, jumpCommand):
+        scope = self._currentFunction or self.fileName
+        if self.sharedComparisons:
+            self._spillTop()
+            return self._writeSharedComparison(jumpCommand, scope)
+        if self.cacheTop:
+            return self._cachedComparison(jumpCommand, scope)
+
         self._genericops.popFromStackToDRegister()
-        uniqueId = self._labelCounter
+        trueLabel = self._newLabel(f"{scope}$IS_TRUE-")
+        endLabel = self._newLabel(f"{scope}$END_OF_CMD-")
 
         self._write("@SP")
         self._write("A=M-1")
         self._write("D=M-D")
 
-        self._write(f"@IS_TRUE.{uniqueId}")
+        self._write(f"@{trueLabel}")
         self._write(f"D;{jumpCommand}")
 
         # IS_FALSE
@@ -266,18 +485,56 @@ class CodeWriter:
         self._write("A=M-1")
         self._write(f"M={BOOLEANS['false']}")
 
-        self._write(f"@END_OF_CMD.{uniqueId}")
+        self._write(f"@{endLabel}")
         self._write("0;JMP")
 
         # IS_TRUE
-        self._write(f"(IS_TRUE.{uniqueId})")
+        self._write(f"({trueLabel})")
         self._write("@SP")
         self._write("A=M-1")
         self._write(f"M={BOOLEANS['true']}")
 
-        self._write(f"(END_OF_CMD.{uniqueId})")
+        self._write(f"({endLabel})")
 
-        self._labelCounter += 1
+    def _writeSharedComparison(self, jumpCommand, scope):
+        # Jump and link: D = return address.
+        endLabel = self._newLabel(f"{scope}$END_OF_CMD-")
+        self._write(f"@{endLabel}")
+        self._write("D=A")
+        self._write(f"@{COMPARISON_ROUTINES[jumpCommand]}")
+        self._write("0;JMP")
+
+        self._write(f"({endLabel})")
+
+    def _writeComparisonRoutine(self, jumpCommand):
+        routine = COMPARISON_ROUTINES[jumpCommand]
+        endLabel = f"{routine}-END"
+        self._defineLabel(routine)
+        self._defineLabel(endLabel)
+        self._write(f"({routine})")
+
+        # R15 = return address
+        self._genericops.changeAddressToDRegister("R15")
+
+        # Pop y, compare it with x and assume the result is true.
+        self._write("@SP")
+        self._write("AM=M-1")
+        self._write("D=M")
+        self._write("A=A-1")
+        self._write("D=M-D")
+        self._write(f"M={BOOLEANS['true']}")
+
+        self._write(f"@{endLabel}")
+        self._write(f"D;{jumpCommand}")
+
+        self._write("@SP")
+        self._write("A=M-1")
+        self._write(f"M={BOOLEANS['false']}")
+
+        self._write(f"({endLabel})")
+        self._write("@R15")
+        self._write("A=M")
+        self._write("0;JMP")
 
     def _eq(self):
         self._comparisonTemplate("JEQ")
@@ -332,12 +589,6 @@ class CodeWriter:
 
         self._genericops.popFromStackToAddressInDRegister()
 
-    def _pushPopGeneric(self, command, segment, index):
-        if command == 'push':
-            return self._pushGeneric(segment, index)
-        if command == 'pop':
-            return self._popGeneric(segment, index)
-
     # === Temp ===
     def _pushTemp(self, index):
         self._write(f"@5")
@@ -356,18 +607,22 @@ class CodeWriter:
 
         self._genericops.popFromStackToAddressInDRegister()
 
-    def _pushPopTemp(self, command, index):
-        if command == 'push':
-            return self._pushTemp(index)
-        if command == 'pop':
-            return self._popTemp(index)
-
     # === Constant ===
     def _pushConstant(self, index):
-        self._write(f"@{index}")
-        self._write(f"D=A")
+        self._loadConstant(index)
         self._genericops.pushFromDRegisterToStack()
 
+    def _loadConstant(self, index):
+        # Negative constants only come from the optimizer.
+        if index == -1:
+            self._write("D=-1")
+        elif index < 0:
+            self._write(f"@{-index}")
+            self._write("D=-A")
+        else:
+            self._write(f"@{index}")
+            self._write("D=A")
+
     # === Pointer ===
     def _pushPointer(self, index):
         segmentPointer = self._getSegmentPointer('that' if index else 'this')
@@ -381,12 +636,6 @@ class CodeWriter:
         self._write(f"D=A")
         self._genericops.popFromStackToAddressInDRegister()
 
-    def _pushPopPointer(self, command, index):
-        if command == 'push':
-            return self._pushPointer(index)
-        if command == 'pop':
-            return self._popPointer(index)
-
     # === Static ===
     def _pushStatic(self, index):
         varName = f"{self.fileName}.{index}"
@@ -400,15 +649,268 @@ class CodeWriter:
         self._write("D=A")
         self._genericops.popFromStackToAddressInDRegister()
 
-    def _pushPopStatic(self, command, index):
-        if command == 'push':
-            return self._pushStatic(index)
-        if command == 'pop':
-            return self._popStatic(index)
+    # === Cached stack top ===
+    def _spillTop(self):
+        # Pushes a stack top cached in D back to memory.
+        if self._topInD:
+            self._write("@SP")
+            self._write("AM=M+1")
+            self._write("A=A-1")
+            self._write("M=D")
+            self._topInD = False
+
+    def _fillTop(self):
+        # Makes D hold the stack top, popping it from memory if needed.
+        if not self._topInD:
+            self._write("@SP")
+            self._write("AM=M-1")
+            self._write("D=M")
+            self._topInD = True
+
+    def _cachedPush(self, segment, index):
+        self._spillTop()
+        self._loadSegment(segment, index)
+        self._topInD = True
+
+    def _cachedPop(self, segment, index):
+        self._fillTop()
+        self._storeSegment(segment, index)
+        self._topInD = False
+
+    def _cachedBinary(self, comp):
+        # D = x op y, popping x from memory.
+        self._fillTop()
+        self._write("@SP")
+        self._write("AM=M-1")
+        self._write(comp)
+
+    def _cachedUnary(self, comp, inMemory):
+        if self._topInD:
+            self._write(comp)
+        else:
+            inMemory()
+
+    def _cachedComparison(self, jumpCommand, scope):
+        # D = x - y, popping x from memory.
+        self._fillTop()
+        self._write("@SP")
+        self._write("AM=M-1")
+        self._write("D=M-D")
+        self._cachedBoolean(jumpCommand, scope)
+
+    def _cachedBoolean(self, jumpCommand, scope):
+        # D = true if D satisfies the jump condition, else false.
+        trueLabel = self._newLabel(f"{scope}$IS_TRUE-")
+        endLabel = self._newLabel(f"{scope}$END_OF_CMD-")
+        self._write(f"@{trueLabel}")
+        self._write(f"D;{jumpCommand}")
+        self._write(f"D={BOOLEANS['false']}")
+        self._write(f"@{endLabel}")
+        self._write("0;JMP")
+        self._write(f"({trueLabel})")
+        self._write(f"D={BOOLEANS['true']}")
+        self._write(f"({endLabel})")
+
+    def _storeSegment(self, segment, index):
+        # segment[index] = D
+        address = self._getDirectAddress(segment, index)
+        if address is not None:
+            return self._genericops.changeAddressToDRegister(address)
+
+        if segment not in SEGMENT_POINTERS:
+            raise ValueError('invalid segment.')
+
+        segmentPointer = self._getSegmentPointer(segment)
+        if index <= STORE_STEP_LIMIT:
+            self._write(f"@{segmentPointer}")
+            self._write("A=M")
+            for k in range(index):
+                self._write("A=A+1")
+            self._write("M=D")
+            return
+
+        # R14 = address, with the value kept in R13 meanwhile.
+        self._genericops.changeAddressToDRegister("R13")
+        self._write(f"@{segmentPointer}")
+        self._write("D=M")
+        self._write(f"@{index}")
+        self._write("D=D+A")
+        self._genericops.changeAddressToDRegister("R14")
+        self._write("@R13")
+        self._write("D=M")
+        self._genericops.pushFromDRegisterToAddress("R14")
+
+    # === Moves ===
+    def _getDirectAddress(self, segment, index):
+        # Symbol or address of a segment entry that needs no pointer
+        # arithmetic, or None.
+        if segment == 'temp':
+            return f"R{5 + index}"
+        if segment == 'pointer':
+            return self._getSegmentPointer('that' if index else 'this')
+        if segment == 'static':
+            return f"{self.fileName}.{index}"
+        return None
+
+    def _loadSegment(self, segment, index):
+        # D = segment[index]
+        if segment == 'constant':
+            return self._loadConstant(index)
+
+        address = self._getDirectAddress(segment, index)
+        if address is not None:
+            self._write(f"@{address}")
+            self._write("D=M")
+            return
+
+        if segment not in SEGMENT_POINTERS:
+            raise ValueError('invalid segment.')
+
+        segmentPointer = self._getSegmentPointer(segment)
+        self._write(f"@{segmentPointer}")
+        if index == 0:
+            self._write("A=M")
+        elif index == 1:
+            self._write("A=M+1")
+        else:
+            self._write("D=M")
+            self._write(f"@{index}")
+            self._write("A=D+A")
+        self._write("D=M")
+
+    # === Locals ===
+    def _writeLocals(self, numLocals):
+        # SP += numLocals, then zero the locals from the top down.
+        self._write(f"@{numLocals}")
+        self._write("D=A")
+        self._write("@SP")
+        self._write("AM=D+M")
+        for k in range(numLocals):
+            self._write("A=A-1")
+            self._write("M=0")
+
+    def _writeLocalsLoop(self, numLocals):
+        loopLabel = self._newLabel(f"{self._currentFunction}$INIT_LOCALS-")
+        self._write(f"@{numLocals}")
+        self._write("D=A")
+        self._write(f"({loopLabel})")
+        self._write("@SP")
+        self._write("AM=M+1")
+        self._write("A=A-1")
+        self._write("M=0")
+        self._write("D=D-1")
+        self._write(f"@{loopLabel}")
+        self._write("D;JGT")
+
+    # === Shared call and return ===
+    def _writeSharedCall(self, functionName, numArgs, returnAddr):
+        # R13 = nArgs, R14 = function, D = return address.
+        self._write(f"@{numArgs}")
+        self._write("D=A")
+        self._write("@R13")
+        self._write("M=D")
+        self._write(f"@{functionName}")
+        self._write("D=A")
+        self._write("@R14")
+        self._write("M=D")
+        self._write(f"@{returnAddr}")
+        self._write("D=A")
+        self._write(f"@{CALL_ROUTINE}")
+        self._write("0;JMP")
+
+        self._write(f"({returnAddr})")
+
+    def _writeCallRoutine(self):
+        self._defineLabel(CALL_ROUTINE)
+        self._write(f"({CALL_ROUTINE})")
+
+        # Push return address and frame.
+        self._pushDRegister()
+        for label in ["LCL", "ARG", "THIS", "THAT"]:
+            self._write(f"@{label}")
+            self._write("D=M")
+            self._pushDRegister()
+
+        # ARG = SP - nArgs - 5
+        self._write("@R13")
+        self._write("D=M")
+        self._write("@5")
+        self._write("D=D+A")
+        self._write("@SP")
+        self._write("D=M-D")
+        self._genericops.changeAddressToDRegister("ARG")
+
+        # LCL = SP
+        self._write("@SP")
+        self._write("D=M")
+        self._genericops.changeAddressToDRegister("LCL")
+
+        # goto f
+        self._write("@R14")
+        self._write("A=M")
+        self._write("0;JMP")
+
+    def _writeReturnRoutine(self):
+        self._defineLabel(RETURN_ROUTINE)
+        self._write(f"({RETURN_ROUTINE})")
+
+        # R13 = FRAME = LCL
+        self._write("@LCL")
+        self._write("D=M")
+        self._genericops.changeAddressToDRegister("R13")
+
+        # R14 = RET = *(FRAME - 5)
+        self._write("@5")
+        self._write("A=D-A")
+        self._write("D=M")
+        self._genericops.changeAddressToDRegister("R14")
+
+        # *ARG = pop()
+        self._write("@SP")
+        self._write("AM=M-1")
+        self._write("D=M")
+        self._genericops.pushFromDRegisterToAddress("ARG")
+
+        # SP = ARG+1
+        self._write("@ARG")
+        self._write("D=M+1")
+        self._genericops.changeAddressToDRegister("SP")
+
+        # Restore THAT, THIS, ARG and LCL from *(FRAME - 1) ... *(FRAME - 4).
+        for label in ["THAT", "THIS", "ARG", "LCL"]:
+            self._write("@R13")
+            self._write("AM=M-1")
+            self._write("D=M")
+            self._genericops.changeAddressToDRegister(label)
+
+        # goto RET
+        self._write("@R14")
+        self._write("A=M")
+        self._write("0;JMP")
+
+    def _pushDRegister(self):
+        self._write("@SP")
+        self._write("AM=M+1")
+        self._write("A=A-1")
+        self._write("M=D")
 
     def _getFunctionReturnLabel(self):
-        uniqueId = ''.join(random.choice('0123456789ABCDEF') for n in range(8))
-        return f"{self._currentFunction}.return-address.{uniqueId}"
+        return self._newLabel(f"{self._currentFunction}.return-address.")
+
+    def _newLabel(self, prefix):
+        # Numbers labels per prefix, so the labels of one function do not
+        # depend on the code of any other.
+        n = self._labelCounters.get(prefix, 0)
+        self._labelCounters[prefix] = n + 1
+
+        label = f"{prefix}{n}"
+        self._defineLabel(label)
+        return label
+
+    def _defineLabel(self, label):
+        if label in self.labels:
+            raise ValueError(f'duplicate label: {label}')
+        self.labels.add(label)
 
     def _getFunctionLabel(self, label):
         return f"{self._currentFunction}${label}"
@@ -0,0 +1,62 @@
+from parser import CommandType
+
+
+# Entry point of a translated directory, called by the bootstrap code.
+ENTRY_FUNCTION = 'Sys.init'
+
+
+def callGraph(programs):
+    # Maps every function defined in `programs`, a dict from file name to
+    # command list, to the set of functions it calls.
+    calls = {}
+    for commands in programs.values():
+        function = None
+        for command in commands:
+            if command.commandType == CommandType.C_FUNCTION:
+                function = command.arg1
+                calls.setdefault(function, set())
+            elif command.commandType == CommandType.C_CALL and function is not None:
+                calls[function].add(command.arg1)
+    return calls
+
+
+def reachableFunctions(calls, root=ENTRY_FUNCTION):
+    reachable = set()
+    pending = [root]
+    while pending:
+        function = pending.pop()
+        if function not in reachable:
+            reachable.add(function)
+            pending.extend(calls.get(function, ()))
+    return reachable
+
+
+def splitDeadFunctions(commands, reachable):
+    # Splits a command list into the commands to keep and the commands of
+    # functions outside `reachable`. Code before the first function is kept.
+    kept = []
+    dead = []
+    target = kept
+    for command in commands:
+        if command.commandType == CommandType.C_FUNCTION:
+            target = kept if command.arg1 in reachable else dead
+        target.append(command)
+    return kept, dead
+
+
+def link(programs, root=ENTRY_FUNCTION):
+    # Drops the functions `root` cannot reach. Returns the linked programs
+    # and the dropped commands per file. Nothing is dropped if `root` is not
+    # defined, since every function could then be an entry point.
+    calls = callGraph(programs)
+    if root not in calls:
+        return programs, {}
+
+    reachable = reachableFunctions(calls, root)
+    linked = {}
+    dropped = {}
+    for fileName, commands in programs.items():
+        linked[fileName], dead = splitDeadFunctions(commands, reachable)
+        if dead:
+            dropped[fileName] = dead
+    return linked, dropped
@@ -0,0 +1,65 @@
+from parser import Command, CommandType
+
+
+# Each rule looks at two adjacent commands and returns the single command
+# replacing them, or None. Labels are commands too, so a pair never spans a
+# jump target.
+def foldNegativeConstant(first, second):
+    # push constant n; neg -> push constant -n
+    if (first.commandType == CommandType.C_PUSH and first.arg1 == 'constant'
+            and second.commandType == CommandType.C_ARITHMETIC and second.arg1 == 'neg'):
+        return Command(CommandType.C_PUSH, 'constant', -first.arg2)
+    return None
+
+
+def fuseMove(first, second):
+    # push X; pop Y -> Y = X, without going through the stack.
+    if first.commandType == CommandType.C_PUSH and second.commandType == CommandType.C_POP:
+        return Command(CommandType.C_MOVE, (first.arg1, first.arg2), (second.arg1, second.arg2))
+    return None
+
+
+def fuseEqualsZero(first, second):
+    # push constant 0; eq -> compare the top of the stack with zero in place.
+    if (first.commandType == CommandType.C_PUSH and first.arg1 == 'constant'
+            and first.arg2 == 0
+            and second.commandType == CommandType.C_ARITHMETIC and second.arg1 == 'eq'):
+        return Command(CommandType.C_EQ_ZERO)
+    return None
+
+
+def fuseIfNot(first, second):
+    # not; if-goto L -> pop and jump unless the value is true (-1).
+    if (first.commandType == CommandType.C_ARITHMETIC and first.arg1 == 'not'
+            and second.commandType == CommandType.C_IF):
+        return Command(CommandType.C_IF_NOT, second.arg1)
+    return None
+
+
+RULES = [
+    ('push constant; neg', foldNegativeConstant),
+    ('push; pop', fuseMove),
+    ('push constant 0; eq', fuseEqualsZero),
+    ('not; if-goto', fuseIfNot),
+]
+
+
+def optimize(commands, hits):
+    # Rewrites the commands with RULES until none applies, counting the hits
+    # of every rule in `hits`. Since rules are tried whenever a command is
+    # added, a fused command can take part in the next rewrite.
+    optimized = []
+    for command in commands:
+        optimized.append(command)
+
+        while len(optimized) >= 2:
+            for name, rule in RULES:
+                fused = rule(optimized[-2], optimized[-1])
+                if fused is not None:
+                    optimized[-2:] = [fused]
+                    hits[name] += 1
+                    break
+            else:
+                break
+
+    return optimized
@@ -9,84 +9,109 @@ class CommandType:
     C_RETURN = 7
     C_CALL = 8
 
+    # Fused commands, produced only by the optimizer.
+    C_MOVE = 9
+    C_EQ_ZERO = 10
+    C_IF_NOT = 11
+
+
+ARITHMETIC_COMMANDS = ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]
+
+COMMAND_TYPES = {
+    **{cmd: CommandType.C_ARITHMETIC for cmd in ARITHMETIC_COMMANDS},
+    "push": CommandType.C_PUSH,
+    "pop": CommandType.C_POP,
+    "label": CommandType.C_LABEL,
+    "goto": CommandType.C_GOTO,
+    "if-goto": CommandType.C_IF,
+    "call": CommandType.C_CALL,
+    "function": CommandType.C_FUNCTION,
+    "return": CommandType.C_RETURN,
+}
+
+# Command types that carry an integer second argument.
+ARG2_COMMAND_TYPES = {
+    CommandType.C_PUSH,
+    CommandType.C_POP,
+    CommandType.C_FUNCTION,
+    CommandType.C_CALL,
+}
+
+
+class Command:
+    # A tokenized VM command. For arithmetic commands arg1 is the command
+    # itself, as returned by Parser.arg1().
+    __slots__ = ("commandType", "arg1", "arg2")
+
+    def __init__(self, commandType, arg1=None, arg2=None):
+        self.commandType = commandType
+        self.arg1 = arg1
+        self.arg2 = arg2
+
+    def __repr__(self):
+        return f"Command({self.commandType}, {self.arg1!r}, {self.arg2!r})"
+
+
+def parseCommand(line):
+    tokens = line.split()
+    commandType = COMMAND_TYPES.get(tokens[0])
+
+    if commandType is None:
+        raise ValueError(f"invalid command: {line}")
+    if commandType == CommandType.C_ARITHMETIC:
+        return Command(commandType, tokens[0])
+    if commandType == CommandType.C_RETURN:
+        return Command(commandType)
+    if commandType in ARG2_COMMAND_TYPES:
+        return Command(commandType, tokens[1], int(tokens[2]))
+    return Command(commandType, tokens[1])
+
 
 class Parser:
+    # Reads the stream in a single buffered pass. Iterating over the parser
+    # yields a Command for every line that is not blank or a comment, and
+    # hasMoreCommands()/advance() walk the same sequence one at a time.
     def __init__(self, stream):
         self.stream = stream
         self.currentCommand = None
+        self.command = None
+        self._lines = self._commandLines()
+        self._nextLine = next(self._lines, None)
 
-    def hasMoreCommands(self):
-        currentPos = self.stream.tell()
-        line = self.stream.readline()
-        self.stream.seek(currentPos)
+    def __iter__(self):
+        while self.hasMoreCommands():
+            self.advance()
+            yield self.command
 
-        return bool(line)
+    def _commandLines(self):
+        for line in self.stream:
+            line = line.rstrip('\n')
+            if not (self._isComment(line) or self._isEmptyLine(line)):
+                yield line
 
-    def advance(self):
-        self.currentCommand = self.stream.readline().rstrip('\n')
+    def hasMoreCommands(self):
+        return self._nextLine is not None
 
-        if self._isComment(self.currentCommand) or self._isEmptyLine(
-            self.currentCommand
-        ):
-            self.advance()
+    def advance(self):
+        self.currentCommand = self._nextLine
+        self._nextLine = next(self._lines, None)
+        self.command = parseCommand(self.currentCommand)
 
     def _isComment(self, line):
         return line.strip().startswith(r"//")
 
     def _isEmptyLine(self, line):
-        return line == ""
-
-    def _rawCommandType(self):
-        return self.currentCommand.split()[0]
-
-    def _rawArg1(self):
-        return self.currentCommand.split()[1]
-
-    def _rawArg2(self):
-        return self.currentCommand.split()[2]
+        return line.strip() == ""
 
     def commandType(self):
-        cmd = self._rawCommandType()
-
-        # Arithmetic / logical commands.
-        if cmd in ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]:
-            return CommandType.C_ARITHMETIC
-
-        # Memory access commands.
-        if cmd == "push":
-            return CommandType.C_PUSH
-        if cmd == "pop":
-            return CommandType.C_POP
-        
-        # Program flow commands.
-        if cmd == "label":
-            return CommandType.C_LABEL
-        if cmd == "goto":
-            return CommandType.C_GOTO
-        if cmd == "if-goto":
-            return CommandType.C_IF
-        if cmd == "call":
-            return CommandType.C_CALL
-        if cmd == "function":
-            return CommandType.C_FUNCTION
-        if cmd == "return":
-            return CommandType.C_RETURN
+        return self.command.commandType
 
     def arg1(self):
-        if self.commandType() == CommandType.C_RETURN:
+        if self.command.commandType == CommandType.C_RETURN:
             raise ValueError("cannot handle C_RETURN command type.")
-        if self.commandType() == CommandType.C_ARITHMETIC:
-            return self._rawCommandType()
-
-        return self._rawArg1()
+        return self.command.arg1
 
     def arg2(self):
-        if self.commandType() in [
-            CommandType.C_PUSH,
-            CommandType.C_POP,
-            CommandType.C_FUNCTION,
-            CommandType.C_CALL,
-        ]:
-            return int(self._rawArg2())
+        if self.command.commandType in ARG2_COMMAND_TYPES:
+            return self.command.arg2
         raise ValueError("invalid command type.")
-
@@ -37,12 +37,13 @@ def getIOPaths(path):
     return paths
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
         raise ValueError("invalid number of arguments provided.")
 
     # Create input and output files.
-    paths = getIOPaths(sys.argv[1])
+    paths = getIOPaths(argv[0])
 
     for inputfile, outputfile in paths:
         print(f"Handling {inputfile}.")
@@ -52,3 +53,7 @@ if __name__ == "__main__":
                 writer = VMWriter(outputstream)
                 engine = CompilationEngine(tokenizer, writer)
                 engine.compileClass()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import io
+import os
+import sys
+import json
+import base64
+import socket
+import argparse
+import traceback
+import contextlib
+import socketserver
+
+
+PROJECTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Tool name -> (directory of the tool, module providing main(argv)).
+TOOLS = {
+    'assemble': ('06', 'assembler'),
+    'translate': (os.path.join('08', 'solution'), 'VMTranslator'),
+    'compile': (os.path.join('11', 'solution'), 'JackCompiler'),
+}
+
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR', '/tmp'), f'hack-toolchain-{os.getuid()}.sock'
+)
+
+
+def load_tools(tools=TOOLS):
+    # Imports the given tools. The tool directories hold no modules with
+    # clashing names, so they can share one sys.path.
+    mains = {}
+    for tool in tools:
+        dirname, modulename = TOOLS[tool]
+        sys.path.insert(0, os.path.join(PROJECTS_DIR, dirname))
+        mains[tool] = __import__(modulename).main
+    return mains
+
+
+def run_tool(main, argv, cwd):
+    # Runs a tool's main() as if it had been started from `cwd`, and returns
+    # its exit status and captured output as bytes.
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    stderr = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    previous_cwd = os.getcwd()
+    status = 0
+
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                main(argv)
+            except SystemExit as exc:
+                status = exc.code if isinstance(exc.code, int) else int(exc.code is not None)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+    finally:
+        os.chdir(previous_cwd)
+
+    stdout.flush()
+    stderr.flush()
+    return status, stdout.buffer.getvalue(), stderr.buffer.getvalue()
+
+
+class ToolchainHandler(socketserver.StreamRequestHandler):
+    # One JSON request per connection: {"tool", "argv", "cwd"}. The reply
+    # holds the exit status and base64-encoded stdout and stderr. Requests
+    # are served one at a time, since tools change the process-wide working
+    # directory and standard streams.
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # A connection closed without a request, e.g. the liveness probe
+            # of another `serve`.
+            return
+
+        request = json.loads(line)
+
+        if request['tool'] == 'stop':
+            self.wfile.write(b'{"status": 0, "stdout": "", "stderr": ""}\n')
+            self.server.stopping = True
+            return
+
+        tool_main = self.server.mains[request['tool']]
+        status, stdout, stderr = run_tool(tool_main, request['argv'], request['cwd'])
+        reply = {
+            'status': status,
+            'stdout': base64.b64encode(stdout).decode(),
+            'stderr': base64.b64encode(stderr).decode(),
+        }
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class ToolchainServer(socketserver.UnixStreamServer):
+    def __init__(self, socketpath):
+        # A socket left behind by a daemon that did not shut down cleanly is
+        # replaced, but a daemon that still answers keeps its socket.
+        if os.path.exists(socketpath):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socketpath)
+            except ConnectionRefusedError:
+                os.remove(socketpath)
+            else:
+                raise RuntimeError(f'a daemon is already listening on {socketpath}.')
+            finally:
+                probe.close()
+
+        super().__init__(socketpath, ToolchainHandler)
+        self.mains = load_tools()
+        self.stopping = False
+
+    def serve(self):
+        try:
+            while not self.stopping:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.server_address)
+
+
+def request_daemon(socketpath, tool, argv):
+    # Sends one request to the daemon. Returns None if no daemon is running.
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socketpath)
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+
+    with client, client.makefile('rwb') as stream:
+        request = {'tool': tool, 'argv': argv, 'cwd': os.getcwd()}
+        stream.write(json.dumps(request).encode() + b'\n')
+        stream.flush()
+        reply = json.loads(stream.readline())
+
+    return (
+        reply['status'],
+        base64.b64decode(reply['stdout']),
+        base64.b64decode(reply['stderr']),
+    )
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Run the Hack toolchain through a long-lived daemon. '
+        'Tool commands fall back to running in this process when no daemon '
+        'is listening.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help=f'Unix domain socket (default: {DEFAULT_SOCKET})')
+    parser.add_argument('command', choices=['serve', 'stop', *TOOLS],
+                        help="'serve' starts the daemon, 'stop' shuts it "
+                        "down, anything else runs that tool")
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='arguments passed on to the tool unchanged')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == 'serve':
+        try:
+            server = ToolchainServer(args.socket)
+        except RuntimeError as exc:
+            print(exc, file=sys.stderr)
+            return 1
+        server.serve()
+        return 0
+
+    reply = request_daemon(args.socket, args.command, args.args)
+    if reply is None:
+        if args.command == 'stop':
+            return 0
+        tool_main = load_tools([args.command])[args.command]
+        reply = run_tool(tool_main, args.args, os.getcwd())
+
+    status, stdout, stderr = reply
+    sys.stdout.buffer.write(stdout)
+    sys.stderr.buffer.write(stderr)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())